@@ -5,22 +5,66 @@ Written by Paul Estrada with lots of pain and suffering
 Only works for photos for now but should be easily adaptable to other upload types
 """
 import pathlib
+import mmap
 import mimetypes
 import uuid
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 import logging
 import random
 import os
 import csv
 import json
-from collections import Counter
+try:
+    import orjson
+except ImportError:  # fall back to the stdlib if orjson isn't installed
+    orjson = None
+import sqlite3
 import re
+from dataclasses import dataclass
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 TOKEN = os.getenv("TOKEN")
 BUBBLE_ID = "4321430"
 warning_message = "" 
-last_message_id = ""
+POLL_INTERVAL = 1.0       # seconds between bubble.history polls
+MAX_POLL_INTERVAL = 60.0  # ceiling for the poll backoff when the API is failing
+active_spawns = []        # (official name, frozenset of lowercased catch names) still waiting to be caught
+spawn_lock = threading.Lock()
+BALLS = []       # rows of balls.csv (minus header) as (official, link, rarity, alternates, names_lc)
+NAME_INDEX = {}  # lowercased official/alternate name -> row in BALLS
+balls_mtime = None
+balls_lock = threading.Lock()  # guards reloading BALLS / NAME_INDEX and writes to display_names
+display_names = {}  # lowercased ball name -> name as it should be shown/stored
+conn = None         # sqlite3 connection to db.sqlite, opened by open_db()
+GIVE_RE = re.compile(r"!give\s+(\S+)\s+<@([^>]+)>")
+
+
+def json_loads(raw):
+    """
+    Parse JSON from bytes/str, using orjson when available.
+    Decode errors are raised as requests' JSONDecodeError, like r.json() does,
+    so callers catching RequestException still see them.
+    """
+    try:
+        if orjson:
+            return orjson.loads(raw)
+        return json.loads(raw)
+    except json.JSONDecodeError as e:
+        raise requests.exceptions.JSONDecodeError(e.msg, e.doc, e.pos) from e
+
+
+@dataclass(slots=True, frozen=True)
+class FileMeta:
+    """Metadata of a normalized upload, as needed for message.create."""
+    name: str
+    filesize: int
+    mimetype: str
+    width: int | None = None
+    height: int | None = None
 
 
 class ProntoUploader:
@@ -30,6 +74,7 @@ class ProntoUploader:
         bubble_id: int,
         base_url: str = "https://stanfordohs.pronto.io",
         log_level: int = logging.INFO,
+        max_workers: int = 4,
     ):
         self.base_url = base_url.rstrip("/")
         self.bubble_id = bubble_id
@@ -38,6 +83,40 @@ class ProntoUploader:
             "Accept": "application/json",
         }
 
+        # one keep-alive session for the whole bot so polls don't redo TLS
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        # POST is left out of the retries: replaying message.create after a gateway
+        # timeout could post the same message twice
+        retry = Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=frozenset({"GET", "PUT"}),
+        )
+        # one pooled connection per worker plus one for the poll loop, so concurrent
+        # requests all stay keep-alive instead of opening throwaway connections
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers + 1, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # bubble.history is a read-only POST, so it is safe to replay
+        history_adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=1,
+            max_retries=retry.new(allowed_methods=frozenset({"POST"})),
+        )
+        self.session.mount(f"{self.base_url}/api/v1/bubble.history", history_adapter)
+
+        # id of the newest message already seen, plus validators from the
+        # last bubble.history response for conditional polls
+        self._last_id = None
+        self._conditional = True  # switched off if the server rejects the validators
+        self._last_etag = None
+        self._last_ts = None
+
+        # background workers so slow uploads don't stall the poll loop
+        self._exec = ThreadPoolExecutor(max_workers=max_workers)
+
         logging.basicConfig(
             level=log_level,
             format="%(asctime)s  %(levelname)-8s %(message)s",
@@ -51,12 +130,22 @@ class ProntoUploader:
         size = p.stat().st_size
         url = f"{self.base_url}/api/files"
         params = {"filename": p.name, "normalize_image": "true"}
-        headers = {**self.headers, "Content-Type": mime, "Content-Length": str(size)}
+        headers = {"Content-Type": mime, "Content-Length": str(size)}
 
+        # hand requests one contiguous buffer so it goes out in a single sendall
+        # instead of being iterated in 8 KB chunks (mmap can't map empty files)
         with p.open("rb") as fh:
-            r = requests.put(url, params=params, data=fh, headers=headers)
+            if size:
+                with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    body = memoryview(mm)
+                    try:
+                        r = self.session.put(url, params=params, data=body, headers=headers)
+                    finally:
+                        body.release()
+            else:
+                r = self.session.put(url, params=params, data=b"", headers=headers)
         r.raise_for_status()
-        data = r.json()["data"]
+        data = json_loads(r.content)["data"]
         self.log.info("Uploaded %s → key=%s", p.name, data["key"])
         return data
 
@@ -64,31 +153,41 @@ class ProntoUploader:
         self,
         orig_key: str,
         preset: str = "PHOTO",
-        tries: int = 6,
+        tries: int = 7,
         delay: float = 0.5,
-    ) -> None:
+        max_delay: float = 5.0,
+    ) -> dict | None:
+        """
+        Poll until the upload is normalized and return the normalized file
+        metadata, or None if it still isn't ready after `tries` attempts.
+        """
         url = f"{self.base_url}/api/clients/files/{orig_key}/normalized"
         for attempt in range(1, tries + 1):
-            r = requests.get(url, params={"preset": preset}, headers=self.headers)
+            r = self.session.get(url, params={"preset": preset})
             r.raise_for_status()
-            if "normalized" in r.json().get("data", {}):
+            data = json_loads(r.content).get("data", {})
+            if "normalized" in data:
                 self.log.info("✓ normalized (attempt %s)", attempt)
-                return
-            time.sleep(delay)
+                return data["normalized"]
+            if attempt == tries:
+                break
+            # exponential backoff with jitter, capped so a slow server isn't hammered
+            time.sleep(min(max_delay, delay * 2 ** (attempt - 1)) * random.uniform(0.8, 1.2))
         self.log.warning("Normalization incomplete after %s attempts", tries)
+        return None
 
     def create_message(
         self,
         orig_key: str = "",
         norm_key: str = "",
-        meta: dict = "",
+        meta: FileMeta | None = None,
         text: str = "",
         media_type: str = "PHOTO",
         tries: int = 3,
     ) -> int:
         payload_stub = {"uuid": str(uuid.uuid4()), "bubble_id": self.bubble_id}
         url = f"{self.base_url}/api/v1/message.create"
-        if (orig_key != "" and norm_key != "" and meta != ""): 
+        if (orig_key != "" and norm_key != "" and meta is not None):
 
             for attempt in range(1, tries + 1):
                 payload = {
@@ -97,16 +196,16 @@ class ProntoUploader:
                     "messagemedia": [
                         {
                             "mediatype": media_type,
-                            "title": meta["name"],
-                            "filesize": meta["filesize"],
-                            "mimetype": meta["mimetype"],
-                            "width": meta["width"],
-                            "height": meta["height"],
+                            "title": meta.name,
+                            "filesize": meta.filesize,
+                            "mimetype": meta.mimetype,
+                            "width": meta.width,
+                            "height": meta.height,
                             "uuid": norm_key,
                         }
                     ],
                 }
-                r = requests.post(url, json=payload, headers=self.headers)
+                r = self.session.post(url, json=payload)
 
                 if r.status_code == 400 and "INVALID_ATTACHMENT_FILE_KEY" in r.text:
                     self.log.warning(
@@ -116,7 +215,7 @@ class ProntoUploader:
                     continue
 
                 r.raise_for_status()
-                msg_id = r.json()["message"]["id"]
+                msg_id = json_loads(r.content)["message"]["id"]
                 self.log.info("✓ posted – message_id=%s", msg_id)
                 return msg_id
 
@@ -126,9 +225,9 @@ class ProntoUploader:
                 **payload_stub,
                 "message": text,
             }
-            r = requests.post(url, json=payload, headers=self.headers)
+            r = self.session.post(url, json=payload)
             r.raise_for_status()
-            msg_id = r.json()["message"]["id"]
+            msg_id = json_loads(r.content)["message"]["id"]
             self.log.info("✓ posted – message_id=%s", msg_id)
             return msg_id
 
@@ -151,121 +250,224 @@ class ProntoUploader:
             type_map = {"image": "PHOTO", "video": "VIDEO", "audio": "AUDIO"}
             preset = type_map.get(category, "PHOTO")
 
-            # 3. wait for normalization under the chosen preset
-            self.wait_until_ready(orig_key, preset=preset)
-
-            # 4. fetch normalized metadata
-            r = requests.get(
-                f"{self.base_url}/api/clients/files/{orig_key}/normalized",
-                params={"preset": preset},
-                headers=self.headers,
+            # 3. wait for normalization under the chosen preset; this also
+            # 4. hands back the normalized metadata
+            norm_data = self.wait_until_ready(orig_key, preset=preset)
+            if norm_data is None:
+                raise RuntimeError(f"Upload {orig_key} was never normalized")
+
+            # 5. prepare meta
+            meta = FileMeta(
+                name=norm_data["name"],
+                filesize=norm_data["filesize"],
+                mimetype=norm_data["mimetype"],
+                width=norm_data.get("width"),
+                height=norm_data.get("height"),
             )
-            r.raise_for_status()
-            norm_data = r.json()["data"]["normalized"]
-
-            # 5. prepare meta dict
-            meta = {
-                "name":     norm_data["name"],
-                "filesize": norm_data["filesize"],
-                "mimetype": norm_data["mimetype"],
-                "width":    norm_data.get("width"),
-                "height":   norm_data.get("height"),
-            }
 
             # 6. create message with appropriate media_type
             return self.create_message(orig_key, norm_data["key"], meta, text, media_type=preset)
         else:
             return self.create_message(text=text)
 
+    def fetch_new_messages(self):
+        """
+        Fetch the messages posted since the last call, oldest first, as
+        [text, user_id, user name] lists. The first call only records where
+        the chat currently is, so history from before startup isn't replayed.
+        """
+        url = f"{self.base_url}/api/v1/bubble.history"
+        data = {"bubble_id": self.bubble_id}
+        headers = {}
+        # let the server short-circuit with a 304/412 / empty page when nothing changed;
+        # if it ignores these we just get the full history as before
+        if self._conditional:
+            if self._last_etag:
+                headers["If-None-Match"] = self._last_etag
+            if self._last_ts:
+                data["modified_after"] = self._last_ts
+        response = self.session.post(url, json=data, headers=headers)
+
+        # a precondition hit on a POST comes back as 412 rather than 304
+        if response.status_code in (304, 412):
+            return []
+
+        # only statuses that mean the header/field itself was refused; 401/403/429
+        # are auth or throttling and go through raise_for_status into the backoff
+        if response.status_code in (400, 422) and (headers or "modified_after" in data):
+            self.log.warning(
+                "bubble.history rejected conditional poll (%s), falling back to plain polls",
+                response.status_code,
+            )
+            self._conditional = False
+            self._last_etag = None
+            self._last_ts = None
+            return self.fetch_new_messages()
+
+        if response.status_code == 200:
+            self._last_etag = response.headers.get("ETag", self._last_etag)
+            messages = json_loads(response.content).get("messages", [])
+            if not messages:
+                return []
+            first_poll = self._last_id is None
+
+            # history comes newest first; take everything above the last one we saw
+            new = []
+            for m in messages:
+                if m["id"] == self._last_id:
+                    break
+                new.append([m["message"], m["user"]["id"], m["user"]["firstname"] +" "+ m["user"]["lastname"]])
+            self._last_id = messages[0]["id"]
+            self._last_ts = messages[0].get("created_at", self._last_ts)
+            if first_poll:
+                return []
+            new.reverse()
+            return new
+
+        else:
+            self.log.error("HTTP error occurred: %s - %s", response.status_code, response.text)
+            response.raise_for_status()
+
+        return []
 
-def fetch_latest_message():
-    global TOKEN
-    global BUBBLE_ID
-    api_base_url = "https://stanfordohs.pronto.io/"
-    bubbleID = BUBBLE_ID
-    global last_message_id
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {TOKEN}",
-    }
+def load_balls():
+    """
+    Parse balls.csv into BALLS / NAME_INDEX, only re-reading it when the file changed.
+    """
+    global BALLS, NAME_INDEX, display_names, balls_mtime
+    with balls_lock:
+        mtime = os.path.getmtime("balls.csv")
+        if mtime == balls_mtime:
+            return
+        balls, index, official = parse_balls()
+        # swap in whole new objects so readers on other threads never see a half-built index
+        names = dict(display_names)
+        names.update(official)
+        BALLS = balls
+        NAME_INDEX = index
+        display_names = names
+        balls_mtime = mtime
+
+
+def parse_balls():
+    """
+    Read balls.csv into (rows, name index, lowercased -> official name).
+    """
+    balls = []
+    index = {}
+    official = {}
+    with open("balls.csv", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        next(reader)  # skip header
+        for parts in reader:
+            alternates = parts[3].split(" ")
+            names_lc = frozenset(n.lower() for n in [parts[0]] + alternates)
+            row = (parts[0], parts[1], parts[2], alternates, names_lc)
+            official[row[0].lower()] = row[0]
+            balls.append(row)
+            for n in names_lc:
+                index.setdefault(n, row)
+
+    return balls, index, official
 
-    """Fetch only the most recent message"""
-    url = f"{api_base_url}api/v1/bubble.history"
-    data = {"bubble_id": bubbleID}
-    response = requests.post(url, headers=headers, json=data)
 
-    if response.status_code == 200:
-        messages = response.json().get("messages", [])
-        if messages[0]["id"] != last_message_id:
-            last_message_id = messages[0]["id"]
-            return [messages[0]["message"], messages[0]["user"]["id"], messages[0]["user"]["firstname"] +" "+ messages[0]["user"]["lastname"]]
+def open_db(path="db.sqlite"):
+    """
+    Open the catches database, creating it (and importing db.json) on first run.
+    Ball names are matched lowercased; `name` keeps the spelling to show.
+    """
+    global conn
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS catches(user_id TEXT, ball TEXT, name TEXT, ts INTEGER)")
+    conn.execute("CREATE INDEX IF NOT EXISTS catches_user_ball ON catches(user_id, ball)")
 
-    else:
-        print(f"HTTP error occurred: {response.status_code} - {response.text}")
+    if not conn.execute("SELECT 1 FROM catches LIMIT 1").fetchone():
+        import_db_json()
 
-    return ["","",""]
+    # official CSV names win; this fills in anything else that was caught/imported
+    with balls_lock:
+        for ball, name in conn.execute("SELECT ball, MIN(name) FROM catches GROUP BY ball"):
+            display_names.setdefault(ball, name)
 
 
-def ballspawn():
-    global TOKEN
-    global BUBBLE_ID
-    ball = list(csv.reader(open('balls.csv')))[random.randint(1,2)]
-    print(ball)
+def import_db_json():
+    """
+    One-time migration from the old {user_id: [ball, ...]} json file.
+    """
+    try:
+        with open("db.json", "rb") as f:
+            raw = json_loads(f.read())
+    except (FileNotFoundError, ValueError):
+        return
+
+    rows = []
+    for uid, balls in raw.items():
+        for b in balls:
+            rows.append((uid, b.lower(), b, 0))
+    with conn:
+        conn.execute("BEGIN")
+        conn.executemany("INSERT INTO catches(user_id, ball, name, ts) VALUES (?, ?, ?, ?)", rows)
+
+
+def ballspawn(uploader):
+    load_balls()
+    if not BALLS:
+        uploader.log.error("No balls to spawn: balls.csv has no rows")
+        return
+    ball = random.choice(BALLS)
+    if uploader.log.isEnabledFor(logging.DEBUG):
+        uploader.log.debug("spawning %s", ball)
     FILE_PATH = "balls/" + ball[1]
     name = ball[0]
-    names = ball[3]
-    names = names.split(' ')
-    names =[x.lower() for x in names]
-    #print(name)
+    names = ball[4]
     rarity = ball[2]
 
-
-    uploader = ProntoUploader(token=TOKEN, bubble_id=BUBBLE_ID)
-
-
     try:
         message_id = uploader.send(FILE_PATH, text="A new ball spawned!")
-        print("Message sent, ID =", message_id)
+        uploader.log.info("sent id=%s", message_id)
     except requests.HTTPError as e:
         uploader.log.error("HTTP error: %s", e)
+        return
     except Exception as e:
         uploader.log.exception("Unexpected error: %s", e)
-    
-    while True:
-        msg = fetch_latest_message()
-        text = msg[0]
-        user_id = str(msg[1])
-        user_name = msg[2]
-        #print(msg)
-        if text.lower()[7:] in names:
-            uploader.send(text = f"<@{user_id}> caught {name}")
-
-            try:
-                with open("db.json", "r") as f:
-                    data = json.load(f)
-            except (FileNotFoundError, json.JSONDecodeError):
-                data = {}
+        return
 
-            if user_id not in data:
-                data[user_id] = []
+    # the monitor loop is the only consumer of new messages, so it does the catching
+    with spawn_lock:
+        active_spawns.append((name, names))
 
-            data[user_id].append(name)
 
-            with open("db.json", "w") as f:
-                json.dump(data, f, indent=4)
-
-            break
+def catch_ball(text, user_id, uploader):
+    """
+    Check a chat message against the balls currently spawned and record the catch.
+    """
+    guess = text.lower()[7:]
+    with spawn_lock:
+        for spawn in active_spawns:
+            if guess in spawn[1]:
+                active_spawns.remove(spawn)
+                break
+        else:
+            return
+    name = spawn[0]
 
+    # record the catch before announcing it, so a failed send can't lose it
+    with balls_lock:
+        display_names.setdefault(name.lower(), name)
+    conn.execute(
+        "INSERT INTO catches(user_id, ball, name, ts) VALUES (?, ?, ?, ?)",
+        (user_id, name.lower(), name, int(time.time())),
+    )
 
+    uploader.send(text = f"<@{user_id}> caught {name}")
 
 
-def give_ball_from_input(input_str, giver_id):
-    global TOKEN
-    global BUBBLE_ID
 
-    uploader = ProntoUploader(token=TOKEN, bubble_id=BUBBLE_ID)
 
+def give_ball_from_input(input_str, giver_id, uploader):
     """
     Parse the input string and call the give function to give the ball.
     input_str is of the form: !give <ball_name> <@Receiver Name>
@@ -273,57 +475,41 @@ def give_ball_from_input(input_str, giver_id):
     """
     result = None
     # Parse the input string using regular expressions
-    match = re.match(r"!give\s+(\S+)\s+<@(.+)>", input_str)
+    match = GIVE_RE.match(input_str)
     if not match:
         result =  "Error: Invalid input format. Example: give Gondor @John Doe"
         uploader.send(text = result)
         return result
     
     ball = match.group(1)  # Extract ball name
-    print(ball)
     receiver_name = match.group(2).strip()  # Extract receiver's name
-    print(receiver_name)
+    if uploader.log.isEnabledFor(logging.DEBUG):
+        uploader.log.debug("give %s -> %s", ball, receiver_name)
 
-    give(ball, giver_id, receiver_name)
+    give(ball, giver_id, receiver_name, uploader)
     return result
 
 
-def give(ball, giver, receiver):
-    global TOKEN
-    global BUBBLE_ID
-
-    uploader = ProntoUploader(token=TOKEN, bubble_id=BUBBLE_ID)
-
-
+def give(ball, giver, receiver, uploader):
     result = None
-    try:
-        # Load the existing data from the JSON file
-        with open("db.json", "r") as f:
-            data = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        data = {}
 
-    # Check if the giver has the ball
     giver_id = str(giver)
-    if giver_id not in data or ball not in data[giver_id]:
+    ball_lc = ball.lower()
+
+    # Move one of the giver's catches of this ball over to the receiver
+    cur = conn.execute(
+        "UPDATE catches SET user_id = ? WHERE rowid = "
+        "(SELECT rowid FROM catches WHERE user_id = ? AND ball = ? LIMIT 1)",
+        (str(receiver), giver_id, ball_lc),
+    )
+    has_ball = cur.rowcount > 0
+
+    if not has_ball:
         result = f"Error: <@{giver}> doesn't have the ball {ball} to give."
         uploader.send(text = result)
         return result
 
-    # Remove one instance of the ball from the giver's list
-    data[giver_id].remove(ball)
-    
-    # If the receiver doesn't exist in the data, create a new entry
-    receiver_id = str(receiver)
-    if receiver_id not in data:
-        data[receiver_id] = []
-
-    # Add the ball to the receiver's list
-    data[receiver_id].append(ball)
-
-    # Save the updated data back to the JSON file
-    with open("db.json", "w") as f:
-        json.dump(data, f, indent=4)
+    ball = display_names.get(ball_lc, ball)
     
     result = f"<@{giver}> has successfully given {ball} to <@{receiver}>."
     uploader.send(text = result)
@@ -331,50 +517,38 @@ def give(ball, giver, receiver):
     
 
 
-def view(ball, user_id):
-    global TOKEN
-    global BUBBLE_ID
+def view(ball, user_id, uploader):
     link = ""
-    uploader = ProntoUploader(token=TOKEN, bubble_id=BUBBLE_ID)
 
     # Step 1: Convert entered name (alternate or main) to official name + get link
     official_name = None
     link = None
 
-    with open("balls.csv", encoding='utf-8') as f:
-        next(f)  # skip header
-        for line in f:
-            parts = line.strip().split(',')
-            main_name = parts[0]
-            image_link = parts[1]
-            alternates = parts[3].split(" ")
-            all_names = [main_name] + alternates
-            if ball.lower() in [n.lower() for n in all_names]:
-                official_name = main_name
-                link = image_link
-                break
+    load_balls()
+    row = NAME_INDEX.get(ball.lower())
+    if row:
+        official_name = row[0]
+        link = row[1]
 
     if not official_name:
         uploader.send(text = "Name not found.")
         return "Name not found."
 
     # Step 2: Check if the user owns the *official* ball name
-    try:
-        with open("db.json", "r") as f:
-            data = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        result = "There was an error loading the database."
-        uploader.send(text=result)
-        return result
-
     giver_id = str(user_id)
-    if giver_id not in data or official_name.lower() not in [x.lower() for x in data[giver_id]]:
+    owned = conn.execute(
+        "SELECT 1 FROM catches WHERE user_id = ? AND ball = ? LIMIT 1",
+        (giver_id, official_name.lower()),
+    ).fetchone()
+    if not owned:
         result = f"Error: You don't have the ball {official_name}."
         uploader.send(text=result)
         return result
 
-    # Step 3: Show the image
-    uploader.send(str("balls/" + link), "")
+    # Step 3: Show the image; the upload + normalization wait can take a while,
+    # so it runs on a worker instead of blocking the poll loop
+    future = uploader._exec.submit(uploader.send, str("balls/" + link), "")
+    future.add_done_callback(log_task_failure)
     return None
 
 
@@ -382,51 +556,93 @@ def view(ball, user_id):
 
 
 
-def monitor_messages():
-    global TOKEN
-    global BUBBLE_ID
+def handle_ball(uploader):
+    future = uploader._exec.submit(ballspawn, uploader)
+    future.add_done_callback(log_task_failure)
 
-    uploader = ProntoUploader(token=TOKEN, bubble_id=BUBBLE_ID)
-    
-    while True:
-        msg = fetch_latest_message()
-        text = msg[0]
-        user_id = str(msg[1])
-        user_name = msg[2]
-        if text == "!ball":
-            ballspawn()
-        if text == "!list":
-            try:
-                with open("db.json", "r") as f:
-                    data = json.load(f)
-            except (FileNotFoundError, json.JSONDecodeError):
-                result = "No data found."
 
-            balls = data.get(str(user_id), [])
+def log_task_failure(future):
+    """Report errors from a background task (spawn, image upload), which would otherwise be dropped."""
+    e = future.exception()
+    if e is not None:
+        logging.getLogger("tasks").error("Background task failed", exc_info=e)
 
-            if not balls:
-                result = f"<@{user_id}> hasn't caught any balls yet."
 
-            ball_counts = Counter(balls)
-            result = f"<@{user_id}> has caught the following balls:\n"
-            
-            for i, (ball, count) in enumerate(ball_counts.items()):
-                result += f"{i+1}. {ball} ({count})\n"
+def handle_list(uploader, user_id):
+    ball_counts = conn.execute(
+        "SELECT ball, COUNT(*) FROM catches WHERE user_id = ? "
+        "GROUP BY ball ORDER BY MIN(rowid)",
+        (str(user_id),),
+    ).fetchall()
 
-            uploader.send("", result)
+    if not ball_counts:
+        result = f"<@{user_id}> hasn't caught any balls yet."
+    else:
+        result = f"<@{user_id}> has caught the following balls:\n"
 
-        if "!give" in text:
-            print(text)
-            give_ball_from_input(text, user_id)
+        for i, (ball, count) in enumerate(ball_counts):
+            result += f"{i+1}. {display_names.get(ball, ball)} ({count})\n"
 
-        if "!view" in text:
-            view(text[6:],user_id)
-            
+    uploader.send("", result)
 
 
+def handle_give(uploader, text, user_id):
+    uploader.log.debug("give command: %s", text)
+    give_ball_from_input(text, user_id, uploader)
+
+
+def handle_view(uploader, arg, user_id):
+    view(arg, user_id, uploader)
+
+
+def handle_message(uploader, text, user_id):
+    catch_ball(text, user_id, uploader)
+
+    parts = text.split(maxsplit=1)
+    cmd = parts[0] if parts else ""
+    arg = parts[1] if len(parts) > 1 else ""
+    match cmd:
+        case "!ball":
+            handle_ball(uploader)
+        case "!list":
+            handle_list(uploader, user_id)
+        case "!give":
+            handle_give(uploader, text, user_id)
+        case "!view":
+            handle_view(uploader, arg, user_id)
+
+
+def monitor_messages(uploader):
+    # the first successful poll just records where the chat is, so old messages aren't handled
+    try:
+        uploader.fetch_new_messages()
+    except requests.RequestException as e:
+        uploader.log.warning("Initial poll failed (%s), starting without a last message", e)
+
+    poll_interval = POLL_INTERVAL
+    failures = 0
+    while True:
+        time.sleep(poll_interval * random.uniform(0.8, 1.2))
+        try:
+            msgs = uploader.fetch_new_messages()
+        except requests.RequestException as e:
+            failures += 1
+            poll_interval = min(poll_interval * 2, MAX_POLL_INTERVAL)
+            uploader.log.warning("Poll failed %s time(s) (%s), next poll in ~%.0fs", failures, e, poll_interval)
+            continue
+        poll_interval = POLL_INTERVAL
+        failures = 0
+        for text, user_id, user_name in msgs:
+            try:
+                handle_message(uploader, text, str(user_id))
+            except requests.RequestException as e:
+                uploader.log.error("Failed to handle %r: %s", text, e)
 
-    
 
 if __name__ == "__main__":
-    #give_ball_from_input("!give Numenor <@5302367>", "5302419")
-    monitor_messages()
+    load_balls()
+    open_db()
+    # one uploader (and so one connection pool) for the whole bot
+    uploader = ProntoUploader(token=TOKEN, bubble_id=BUBBLE_ID)
+    #give_ball_from_input("!give Numenor <@5302367>", "5302419", uploader)
+    monitor_messages(uploader)